@@ -3,7 +3,9 @@
 Tests for assessment models.
 """
 
-import copy
+import ddt
+from django.test import SimpleTestCase
+
 from openassessment.test_utils import CacheResetTest
 from openassessment.assessment.models import (
     Rubric, Criterion, CriterionOption, InvalidRubricSelection
@@ -11,6 +13,74 @@ from openassessment.assessment.models import (
 from openassessment.assessment.test.constants import RUBRIC
 
 
+def _copy_rubric(value):
+    """
+    Copy the dicts and lists of a rubric dict, sharing the immutable leaves.
+
+    Cheaper than `copy.deepcopy` for the plain JSON-like rubric structure,
+    since there is no memo to maintain and no per-type dispatch.
+    Unlike `copy.deepcopy`, aliased sub-structures (such as an options list
+    shared by several criteria) become independent copies.
+    """
+    if type(value) is dict:
+        return {key: _copy_rubric(item) for key, item in value.iteritems()}
+    elif type(value) is list:
+        return [_copy_rubric(item) for item in value]
+    else:
+        return value
+
+
+def _altered_structure_hashes():
+    """
+    Hash altered copies of the test rubric.
+
+    Returns:
+        dict mapping alteration names to structure hashes
+
+    """
+    # Same structure, but different text
+    text_altered = _copy_rubric(RUBRIC)
+    text_altered['prompts'] = [{"description": 'altered!'}]
+    for criterion in text_altered['criteria']:
+        criterion['prompt'] = 'altered!'
+        for option in criterion['options']:
+            option['explanation'] = 'altered!'
+
+    # Same structure, with some extra keys
+    extra_keys = _copy_rubric(RUBRIC)
+    extra_keys['extra'] = 'extra!'
+    extra_keys['criteria'][0]['extra'] = 'extra!'
+    extra_keys['criteria'][0]['options'][0]['extra'] = 'extra!'
+
+    criterion_order = _copy_rubric(RUBRIC)
+    criterion_order['criteria'][0]['order_num'] = 5
+
+    criterion_name = _copy_rubric(RUBRIC)
+    criterion_name['criteria'][0]['name'] = 'altered!'
+
+    option_order = _copy_rubric(RUBRIC)
+    option_order['criteria'][0]['options'][0]['order_num'] = 5
+
+    option_name = _copy_rubric(RUBRIC)
+    option_name['criteria'][0]['options'][0]['name'] = 'altered!'
+
+    option_points = _copy_rubric(RUBRIC)
+    option_points['criteria'][0]['options'][0]['points'] = 'altered!'
+
+    return {
+        name: Rubric.structure_hash_from_dict(altered_rubric)
+        for name, altered_rubric in [
+            ('text', text_altered),
+            ('extra_keys', extra_keys),
+            ('criterion_order', criterion_order),
+            ('criterion_name', criterion_name),
+            ('option_order', option_order),
+            ('option_name', option_name),
+            ('option_points', option_points),
+        ]
+    }
+
+
 class RubricIndexTest(CacheResetTest):
     """
     Test selection of options from a rubric.
@@ -19,60 +89,98 @@ class RubricIndexTest(CacheResetTest):
     NUM_CRITERIA = 4
     NUM_OPTIONS = 3
 
-    def setUp(self):
+    CRITERION_NAMES = tuple("test criterion {num}".format(num=num) for num in range(NUM_CRITERIA))
+    OPTION_NAMES = tuple("test option {num}".format(num=num) for num in range(NUM_OPTIONS))
+
+    @classmethod
+    def setUpTestData(cls):
         """
         Create a rubric in the database.
+
+        The rows are created once for the whole class; each test
+        runs inside a transaction that is rolled back afterwards.
         """
-        super(RubricIndexTest, self).setUp()
+        cls.rubric = Rubric.objects.create()
+
+        # SQLite does not report primary keys back from `bulk_create`,
+        # so reload the criteria to get saved instances for the options.
+        Criterion.objects.bulk_create([
+            Criterion(
+                rubric=cls.rubric,
+                name=name,
+                order_num=num,
+            ) for num, name in enumerate(cls.CRITERION_NAMES)
+        ])
+        cls.criteria = list(Criterion.objects.filter(rubric=cls.rubric))
 
-        self.rubric = Rubric.objects.create()
-        self.criteria = [
-            Criterion.objects.create(
-                rubric=self.rubric,
-                name="test criterion {num}".format(num=num),
+        CriterionOption.objects.bulk_create([
+            CriterionOption(
+                criterion=criterion,
+                name=name,
                 order_num=num,
-            ) for num in range(self.NUM_CRITERIA)
-        ]
+                points=num
+            )
+            for criterion in cls.criteria
+            for num, name in enumerate(cls.OPTION_NAMES)
+        ])
+
+        # Reload the saved options grouped under their criteria.  This only
+        # builds `cls.criteria` and `cls.options`; `setUp` gives each test
+        # its own unprefetched rubric.
+        cls.rubric = Rubric.objects.prefetch_related('criteria__options').get(pk=cls.rubric.pk)
+        cls.criteria = list(cls.rubric.criteria.all())
+        cls.options = {
+            criterion.name: list(criterion.options.all())
+            for criterion in cls.criteria
+        }
+
+    def setUp(self):
+        super(RubricIndexTest, self).setUp()
+
+        # `Rubric.index` is cached on the model instance, so give each
+        # test its own instance to pick up rows it creates or modifies.
+        self.rubric = Rubric.objects.get(pk=self.rubric.pk)
+
+    def _selection(self, option_nums):
+        """
+        Pair each criterion name with an option number.
+
+        Args:
+            option_nums (list of int): The option number for each criterion, in order.
 
-        self.options = dict()
-        for criterion in self.criteria:
-            self.options[criterion.name] = [
-                CriterionOption.objects.create(
-                    criterion=criterion,
-                    name="test option {num}".format(num=num),
-                    order_num=num,
-                    points=num
-                ) for num in range(self.NUM_OPTIONS)
-            ]
+        Returns:
+            dict mapping criterion names to option numbers
+
+        """
+        return dict(zip(self.CRITERION_NAMES, option_nums))
 
     def test_find_option(self):
-        self.assertEqual(
-            self.rubric.index.find_option("test criterion 0", "test option 0"),
-            self.options["test criterion 0"][0]
-        )
-        self.assertEqual(
-            self.rubric.index.find_option("test criterion 1", "test option 1"),
-            self.options["test criterion 1"][1]
-        )
-        self.assertEqual(
-            self.rubric.index.find_option("test criterion 2", "test option 2"),
-            self.options["test criterion 2"][2]
-        )
-        self.assertEqual(
-            self.rubric.index.find_option("test criterion 3", "test option 0"),
-            self.options["test criterion 3"][0]
-        )
+        # Loading the index queries the criteria and the options ...
+        with self.assertNumQueries(2):
+            index = self.rubric.index
+
+        # ... after which lookups are served from memory
+        with self.assertNumQueries(0):
+            for criterion_name, num in self._selection([0, 1, 2, 0]).iteritems():
+                self.assertEqual(
+                    index.find_option(criterion_name, self.OPTION_NAMES[num]),
+                    self.options[criterion_name][num]
+                )
 
     def test_find_missing_criteria(self):
-        missing = self.rubric.index.find_missing_criteria([
-            'test criterion 0', 'test criterion 1', 'test criterion 3'
-        ])
-        expected_missing = set(['test criterion 2'])
-        self.assertEqual(missing, expected_missing)
+        with self.assertNumQueries(2):
+            index = self.rubric.index
+
+        with self.assertNumQueries(0):
+            missing = index.find_missing_criteria([
+                self.CRITERION_NAMES[0], self.CRITERION_NAMES[1], self.CRITERION_NAMES[3]
+            ])
+            expected_missing = {self.CRITERION_NAMES[2]}
+            self.assertEqual(missing, expected_missing)
 
     def test_invalid_option(self):
         with self.assertRaises(InvalidRubricSelection):
-            self.rubric.index.find_option("test criterion 0", "invalid")
+            self.rubric.index.find_option(self.CRITERION_NAMES[0], "invalid")
 
     def test_valid_option_wrong_criterion(self):
         # Add another option to the first criterion
@@ -86,47 +194,41 @@ class RubricIndexTest(CacheResetTest):
         # We should be able to find it in the first criterion
         self.assertEqual(
             new_option,
-            self.rubric.index.find_option("test criterion 0", "extra option")
+            self.rubric.index.find_option(self.CRITERION_NAMES[0], "extra option")
         )
 
         # ... but not from another criterion
         with self.assertRaises(InvalidRubricSelection):
-            self.rubric.index.find_option("test criterion 1", "extra option")
+            self.rubric.index.find_option(self.CRITERION_NAMES[1], "extra option")
 
     def test_find_option_for_points(self):
-        self.assertEqual(
-            self.rubric.index.find_option_for_points("test criterion 0", 0),
-            self.options["test criterion 0"][0]
-        )
-        self.assertEqual(
-            self.rubric.index.find_option_for_points("test criterion 1", 1),
-            self.options["test criterion 1"][1]
-        )
-        self.assertEqual(
-            self.rubric.index.find_option_for_points("test criterion 2", 2),
-            self.options["test criterion 2"][2]
-        )
-        self.assertEqual(
-            self.rubric.index.find_option_for_points("test criterion 3", 1),
-            self.options["test criterion 3"][1]
-        )
+        with self.assertNumQueries(2):
+            index = self.rubric.index
+
+        # Each option is worth as many points as its position in the criterion
+        with self.assertNumQueries(0):
+            for criterion_name, num in self._selection([0, 1, 2, 1]).iteritems():
+                self.assertEqual(
+                    index.find_option_for_points(criterion_name, num),
+                    self.options[criterion_name][num]
+                )
 
     def test_find_option_for_points_first_of_duplicate_points(self):
         # Change the first criterion options so that the second and third
-        # option have the same point value
-        self.options['test criterion 0'][1].points = 5
-        self.options['test criterion 0'][1].save()
-        self.options['test criterion 0'][2].points = 5
-        self.options['test criterion 0'][2].save()
+        # option have the same point value.  Update the rows directly
+        # so the options shared by every test are left untouched.
+        CriterionOption.objects.filter(
+            pk__in=[option.pk for option in self.options[self.CRITERION_NAMES[0]][1:]]
+        ).update(points=5)
 
         # Should get the first option back
-        option = self.rubric.index.find_option_for_points("test criterion 0", 5)
-        self.assertEqual(option, self.options['test criterion 0'][1])
+        option = self.rubric.index.find_option_for_points(self.CRITERION_NAMES[0], 5)
+        self.assertEqual(option, self.options[self.CRITERION_NAMES[0]][1])
 
     def test_find_option_for_points_invalid_selection(self):
         # No such point value
         with self.assertRaises(InvalidRubricSelection):
-            self.rubric.index.find_option_for_points("test criterion 0", 10)
+            self.rubric.index.find_option_for_points(self.CRITERION_NAMES[0], 10)
 
         # No such criterion
         with self.assertRaises(InvalidRubricSelection):
@@ -144,77 +246,33 @@ class RubricIndexTest(CacheResetTest):
         # We should be able to find it in the first criterion
         self.assertEqual(
             new_option,
-            self.rubric.index.find_option_for_points("test criterion 0", 10)
+            self.rubric.index.find_option_for_points(self.CRITERION_NAMES[0], 10)
         )
 
         # ... but not from another criterion
         with self.assertRaises(InvalidRubricSelection):
-            self.rubric.index.find_option_for_points("test criterion 1", 10)
+            self.rubric.index.find_option_for_points(self.CRITERION_NAMES[1], 10)
 
 
-class RubricHashTest(CacheResetTest):
+@ddt.ddt
+class RubricHashTest(SimpleTestCase):
     """
     Tests of the rubric content and structure hash.
+
+    Hashing works on plain dicts and touches neither the database
+    nor the cache, so these tests skip the transaction wrapping and
+    cache resets of `CacheResetTest`.
     """
-    def test_structure_hash_identical(self):
-        first_hash = Rubric.structure_hash_from_dict(RUBRIC)
-
-        # Same structure, but different text should have the same structure hash
-        altered_rubric = copy.deepcopy(RUBRIC)
-        altered_rubric['prompts'] = [{"description": 'altered!'}]
-        for criterion in altered_rubric['criteria']:
-            criterion['prompt'] = 'altered!'
-            for option in criterion['options']:
-                option['explanation'] = 'altered!'
-        second_hash = Rubric.structure_hash_from_dict(altered_rubric)
-
-        # Expect that the two hashes are the same
-        self.assertEqual(first_hash, second_hash)
-
-    def test_structure_hash_extra_keys(self):
-        first_hash = Rubric.structure_hash_from_dict(RUBRIC)
-
-        # Same structure, add some extra keys
-        altered_rubric = copy.deepcopy(RUBRIC)
-        altered_rubric['extra'] = 'extra!'
-        altered_rubric['criteria'][0]['extra'] = 'extra!'
-        altered_rubric['criteria'][0]['options'][0]['extra'] = 'extra!'
-        second_hash = Rubric.structure_hash_from_dict(altered_rubric)
-
-        # Expect that the two hashes are the same
-        self.assertEqual(first_hash, second_hash)
-
-    def test_structure_hash_criterion_order_changed(self):
-        first_hash = Rubric.structure_hash_from_dict(RUBRIC)
-        altered_rubric = copy.deepcopy(RUBRIC)
-        altered_rubric['criteria'][0]['order_num'] = 5
-        second_hash = Rubric.structure_hash_from_dict(altered_rubric)
-        self.assertNotEqual(first_hash, second_hash)
-
-    def test_structure_hash_criterion_name_changed(self):
-        first_hash = Rubric.structure_hash_from_dict(RUBRIC)
-        altered_rubric = copy.deepcopy(RUBRIC)
-        altered_rubric['criteria'][0]['name'] = 'altered!'
-        second_hash = Rubric.structure_hash_from_dict(altered_rubric)
-        self.assertNotEqual(first_hash, second_hash)
-
-    def test_structure_hash_option_order_changed(self):
-        first_hash = Rubric.structure_hash_from_dict(RUBRIC)
-        altered_rubric = copy.deepcopy(RUBRIC)
-        altered_rubric['criteria'][0]['options'][0]['order_num'] = 5
-        second_hash = Rubric.structure_hash_from_dict(altered_rubric)
-        self.assertNotEqual(first_hash, second_hash)
-
-    def test_structure_hash_option_name_changed(self):
-        first_hash = Rubric.structure_hash_from_dict(RUBRIC)
-        altered_rubric = copy.deepcopy(RUBRIC)
-        altered_rubric['criteria'][0]['options'][0]['name'] = 'altered!'
-        second_hash = Rubric.structure_hash_from_dict(altered_rubric)
-        self.assertNotEqual(first_hash, second_hash)
-
-    def test_structure_hash_option_points_changed(self):
-        first_hash = Rubric.structure_hash_from_dict(RUBRIC)
-        altered_rubric = copy.deepcopy(RUBRIC)
-        altered_rubric['criteria'][0]['options'][0]['points'] = 'altered!'
-        second_hash = Rubric.structure_hash_from_dict(altered_rubric)
-        self.assertNotEqual(first_hash, second_hash)
+
+    # Structure hashes of the unmodified and altered rubrics, shared by every test.
+    RUBRIC_HASH = Rubric.structure_hash_from_dict(RUBRIC)
+    ALTERED_HASHES = _altered_structure_hashes()
+
+    @ddt.data('text', 'extra_keys')
+    def test_structure_hash_same_structure(self, alteration):
+        # Changing the text or adding extra keys should not change the structure hash
+        self.assertEqual(self.RUBRIC_HASH, self.ALTERED_HASHES[alteration])
+
+    @ddt.data('criterion_order', 'criterion_name', 'option_order', 'option_name', 'option_points')
+    def test_structure_hash_changed(self, alteration):
+        self.assertNotEqual(self.RUBRIC_HASH, self.ALTERED_HASHES[alteration])